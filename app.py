@@ -1,4 +1,6 @@
 import os
+import hashlib
+import tempfile
 import numpy as np
 import pandas as pd
 import streamlit as st
@@ -14,6 +16,11 @@ import json
 # ---------------------------
 DEFAULT_FILE = "trial_balance.xlsx"
 DEFAULT_SHEET = "trial_balance"
+REQUIRED_COLUMNS = frozenset({"Account ID", "Account Description", "Debit Amt", "Credit Amt", "Last FYE Bal", "Type"})
+
+# On-disk cache of parsed workbooks (bump the version when load_df output changes)
+CACHE_DIR = ".cache"
+CACHE_VERSION = 7
 
 # Premium Dark Grey Color Scheme
 COLORS = {
@@ -34,6 +41,12 @@ COLORS = {
 
 LOGO_PATH = "iqra-university-seeklogo.png"
 
+# Sunburst layout degrades badly past this many leaves; fall back to the treemap only
+SUNBURST_MAX_NODES = 800
+
+# Cached Plotly figures are shared across sessions; cap how many each builder keeps
+FIGURE_CACHE_ENTRIES = 32
+
 # ---------------------------
 # Utility functions
 # ---------------------------
@@ -58,9 +71,24 @@ def fmt_money(x, decimals=2):
     except:
         return str(x)
 
+def fmt_money_vec(arr, decimals=2):
+    """Vectorized fmt_money: format a whole array of amounts in one pass."""
+    arr = np.asarray(arr, dtype=float)
+    mag = np.abs(arr)
+    conds = [mag >= 1e9, mag >= 1e6, mag >= 1e3]
+    bucket = np.select(conds, [0, 1, 2], default=3)
+    scaled = arr / np.select(conds, [1e9, 1e6, 1e3], default=1.0)
+    
+    out = np.empty(arr.shape, dtype=object)
+    for b, suffix in enumerate(["B", "M", "K", ""]):
+        sel = bucket == b
+        if sel.any():
+            out[sel] = list(map(f"${{:,.{decimals}f}}{suffix}".format, scaled[sel]))
+    return out
+
 def safe_pct(cy, ly):
     """Calculate safe percentage change."""
-    if ly is None or np.isclose(ly, 0.0):
+    if ly is None or pd.isna(ly) or np.isclose(ly, 0.0):
         return None
     try:
         return (cy - ly) / abs(ly)
@@ -70,7 +98,7 @@ def safe_pct(cy, ly):
 def make_yoy_str(cy, ly):
     """Create year-over-year percentage string with proper formatting."""
     p = safe_pct(cy, ly)
-    if p is None:
+    if p is None or pd.isna(p):
         return "—"
     sign = "+" if p >= 0 else ""
     return f"{sign}{p*100:.1f}%"
@@ -78,7 +106,7 @@ def make_yoy_str(cy, ly):
 def get_trend_icon(cy, ly):
     """Get trend icon based on comparison."""
     p = safe_pct(cy, ly)
-    if p is None:
+    if p is None or pd.isna(p):
         return "➖"
     elif p > 0:
         return "📈"
@@ -87,6 +115,26 @@ def get_trend_icon(cy, ly):
     else:
         return "➖"
 
+def safe_pct_vec(cy: pd.Series, ly: pd.Series) -> pd.Series:
+    """Calculate safe percentage change for whole columns (NaN where LY is zero)."""
+    cy = cy.astype(float)
+    ly = ly.astype(float)
+    return (cy - ly) / ly.abs().where(~np.isclose(ly, 0.0))
+
+def make_yoy_str_vec(cy: pd.Series, ly: pd.Series) -> pd.Series:
+    """Vectorized make_yoy_str over CY/LY columns."""
+    p = safe_pct_vec(cy, ly)
+    out = pd.Series("—", index=p.index, dtype=object)
+    valid = p.notna()
+    out[valid] = p[valid].mul(100).map("{:+.1f}%".format)
+    return out
+
+def get_trend_icon_vec(cy: pd.Series, ly: pd.Series) -> pd.Series:
+    """Vectorized get_trend_icon over CY/LY columns."""
+    p = safe_pct_vec(cy, ly)
+    icons = np.select([p > 0, p < 0, p.isna()], ["📈", "📉", "➖"], default="➖")
+    return pd.Series(icons, index=p.index)
+
 def get_category_icon(category):
     """Get appropriate icon for each category."""
     icons = {
@@ -100,56 +148,156 @@ def get_category_icon(category):
     }
     return icons.get(category, "📊")
 
+def normalize_types(types: pd.Series) -> pd.Series:
+    """Strip and upper-case account types, returned as a category."""
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        arr = pa.array(types, type=pa.string(), from_pandas=True)
+    except (ImportError, TypeError, ValueError):
+        # No pyarrow, or non-string cells - take the pandas route
+        return types.astype(str).str.strip().str.upper().astype("category")
+    
+    # Trim + upper in arrow, then dictionary-encode straight into a categorical
+    encoded = pc.utf8_upper(pc.utf8_trim_whitespace(arr)).dictionary_encode()
+    return pd.Series(encoded.to_pandas().array, index=types.index, name=types.name)
+
+def to_text_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Store the text columns as contiguous arrow strings where pyarrow is available."""
+    try:
+        text_dtype = pd.StringDtype("pyarrow")
+    except ImportError:
+        text_dtype = pd.StringDtype()
+    for col in ["Account ID", "Account Description"]:
+        df[col] = df[col].astype(text_dtype)
+    return df
+
 @st.cache_data
 def load_df(path: str, sheet: str):
     """Load and process Excel data with caching."""
-    import openpyxl
     if not os.path.exists(path):
         raise FileNotFoundError(path)
     
-    df = pd.read_excel(path, sheet_name=sheet, engine="openpyxl", dtype={"Account ID": str})
+    # Reuse a previously parsed copy of this exact workbook if we have one
+    with open(path, "rb") as f:
+        file_hash = hashlib.sha1(f.read()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{file_hash}_{sheet}_v{CACHE_VERSION}.parquet")
+    if os.path.exists(cache_path):
+        try:
+            # Parquet round-trips may hand back python-backed strings (pandas 2.2)
+            return to_text_dtypes(pd.read_parquet(cache_path))
+        except Exception:
+            # Truncated or otherwise unreadable cache file - discard it and re-parse
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+    
+    # Only keep the columns we use; headers are matched after stripping whitespace
+    read_kwargs = dict(
+        sheet_name=sheet,
+        usecols=lambda c: str(c).strip() in REQUIRED_COLUMNS,
+        dtype={"Account ID": str}
+    )
+    try:
+        df = pd.read_excel(path, engine="calamine", **read_kwargs)
+    except ImportError:
+        # python-calamine not installed - fall back to the slower openpyxl reader
+        df = pd.read_excel(path, engine="openpyxl", **read_kwargs)
     df.columns = [c.strip() for c in df.columns]
     
-    required = {"Account ID", "Account Description", "Debit Amt", "Credit Amt", "Last FYE Bal", "Type"}
-    missing = required - set(df.columns)
+    missing = REQUIRED_COLUMNS - set(df.columns)
     if missing:
         raise ValueError(f"Required columns missing: {missing}")
     
     # Clean and convert numeric columns
     for col in ["Debit Amt", "Credit Amt", "Last FYE Bal"]:
-        df[col] = df[col].astype(str).str.replace(",", "", regex=False).str.strip()
-        df[col] = pd.to_numeric(df[col].replace({"": "0", "nan": "0", "None": "0"}), errors="coerce").fillna(0.0)
+        col_s = df[col]
+        if pd.api.types.is_numeric_dtype(col_s):
+            # Already numeric in the workbook - skip the string round-trip
+            df[col] = col_s.fillna(0.0).astype("float64")
+        else:
+            col_s = col_s.astype("string").str.replace(",", "", regex=False).str.strip()
+            df[col] = pd.to_numeric(
+                col_s.replace({"": None, "nan": None, "None": None}), errors="coerce"
+            ).fillna(0.0).astype("float64")
     
-    df["Type"] = df["Type"].astype(str).str.strip().str.upper()
+    # Few distinct types: store as category so filters compare integer codes
+    df["Type"] = normalize_types(df["Type"])
     df["CY_Amount"] = df["Debit Amt"] - df["Credit Amt"]
     df["LY_Amount"] = df["Last FYE Bal"].astype(float)
     
     # Add calculated fields
     df["YoY_Change"] = df["CY_Amount"] - df["LY_Amount"]
-    df["YoY_Pct"] = df.apply(lambda x: safe_pct(x["CY_Amount"], x["LY_Amount"]), axis=1)
+    ly = df["LY_Amount"].to_numpy()
+    mask = ~np.isclose(ly, 0.0)
+    df["YoY_Pct"] = np.where(mask, (df["CY_Amount"].to_numpy() - ly) / np.where(mask, np.abs(ly), 1.0), np.nan)
+    
+    # Amounts stay float64: balances run past $1B, well beyond float32's cent precision
+    df = to_text_dtypes(df)
+    
+    # Write to a temp file and move it into place so readers never see a partial file
+    tmp_path = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".parquet.tmp")
+        os.close(fd)
+        # mkstemp creates 0600 files; give the cache normal umask-based permissions
+        # so other accounts running the dashboard can read it
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        df.to_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, cache_path)
+    except (ImportError, OSError):
+        # Caching is best-effort; the parsed frame is still usable
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
     
     return df
 
+@st.cache_data
+def compute_totals(df: pd.DataFrame, types: tuple):
+    """Filter to the selected account types and aggregate CY/LY per type."""
+    df_f = df[df["Type"].isin(types)]
+    agg = df_f.groupby("Type", sort=False, observed=True)[["CY_Amount", "LY_Amount"]].sum()
+    return df_f, agg
+
+@st.cache_data
+def lower_descriptions(df: pd.DataFrame) -> np.ndarray:
+    """Lower-cased account descriptions as a NumPy string array for searching."""
+    return df["Account Description"].str.lower().fillna("").to_numpy(dtype=str)
+
+@st.cache_data
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    """Encode a frame as CSV bytes, cached on the frame's contents."""
+    return df.to_csv(index=False).encode()
+
 def top_n_with_other(df: pd.DataFrame, n=10):
     """Get top N items with 'Other' category for remaining items."""
-    df_sorted = df.sort_values("CY_Amount", ascending=False).copy()
-    top = df_sorted.head(n).copy()
-    rest = df_sorted.iloc[n:].copy()
-    
-    top["Label"] = top["Account Description"].astype(str)
+    cols = ["Label", "CY_Amount", "LY_Amount", "YoY_Change", "YoY_Pct"]
+    if n >= len(df):
+        top = df.sort_values("CY_Amount", ascending=False)
+    else:
+        top = df.nlargest(n, "CY_Amount")
+    top = top.assign(Label=top["Account Description"].astype(str))
     
+    # Sum the remainder directly; total-minus-top cancels and leaves
+    # rounding noise where the remaining LY is exactly zero
+    rest = df.loc[~df.index.isin(top.index), ["CY_Amount", "LY_Amount", "YoY_Change"]]
     if len(rest) > 0:
+        rest_cy = rest["CY_Amount"].sum()
+        rest_ly = rest["LY_Amount"].sum()
         other = {
             "Label": f"Other ({len(rest)} accts)",
-            "CY_Amount": rest["CY_Amount"].sum(),
-            "LY_Amount": rest["LY_Amount"].sum(),
+            "CY_Amount": rest_cy,
+            "LY_Amount": rest_ly,
             "YoY_Change": rest["YoY_Change"].sum(),
-            "YoY_Pct": safe_pct(rest["CY_Amount"].sum(), rest["LY_Amount"].sum())
+            "YoY_Pct": safe_pct(rest_cy, rest_ly)
         }
-        top_out = pd.concat([top[["Label","CY_Amount","LY_Amount","YoY_Change","YoY_Pct"]], 
-                           pd.DataFrame([other])], ignore_index=True)
+        top_out = pd.concat([top[cols], pd.DataFrame([other])], ignore_index=True)
     else:
-        top_out = top[["Label","CY_Amount","LY_Amount","YoY_Change","YoY_Pct"]]
+        top_out = top[cols]
     
     # Add ranking
     top_out = top_out.reset_index(drop=True)
@@ -157,14 +305,22 @@ def top_n_with_other(df: pd.DataFrame, n=10):
     
     return top_out
 
-def create_kpi_card(title, value, delta, icon, color):
-    """Create a styled KPI card with custom HTML."""
-    trend_color = COLORS["positive"] if delta and delta != "—" and not delta.startswith("-") else COLORS["negative"]
-    
-    return f"""
+def type_totals(agg: pd.DataFrame, type_name: str):
+    """Get CY/LY totals for one account type from a per-type aggregate."""
+    if type_name in agg.index:
+        cy = float(agg.loc[type_name, "CY_Amount"])
+        ly = float(agg.loc[type_name, "LY_Amount"])
+    else:
+        cy = ly = 0.0
+    return {"cy": cy, "ly": ly, "icon": get_category_icon(type_name)}
+
+@st.cache_resource
+def build_kpi_template() -> str:
+    """Build the KPI card markup with the theme colors filled in, once per server process."""
+    return """
     <div style="
-        background: linear-gradient(135deg, {COLORS['card_bg']}, {adjust_hex_color(COLORS['card_bg'], 1.05)});
-        border: 1px solid {COLORS['border']};
+        background: linear-gradient(135deg, %(card_bg)s, %(card_bg_light)s);
+        border: 1px solid %(border)s;
         border-radius: 12px;
         padding: 20px;
         margin: 10px 0;
@@ -173,16 +329,24 @@ def create_kpi_card(title, value, delta, icon, color):
     ">
         <div style="display: flex; align-items: center; margin-bottom: 10px;">
             <span style="font-size: 24px; margin-right: 10px;">{icon}</span>
-            <span style="color: {COLORS['secondary_text']}; font-size: 14px; font-weight: 500;">{title}</span>
+            <span style="color: %(secondary_text)s; font-size: 14px; font-weight: 500;">{title}</span>
         </div>
-        <div style="font-size: 28px; font-weight: bold; color: {COLORS['primary_text']}; margin-bottom: 5px;">
+        <div style="font-size: 28px; font-weight: bold; color: %(primary_text)s; margin-bottom: 5px;">
             {value}
         </div>
         <div style="color: {trend_color}; font-size: 14px; font-weight: 500;">
             {delta}
         </div>
     </div>
-    """
+    """ % {
+        **COLORS,
+        "card_bg_light": adjust_hex_color(COLORS["card_bg"], 1.05)
+    }
+
+def create_kpi_card(title, value, delta, icon, color):
+    """Create a styled KPI card with custom HTML."""
+    trend_color = COLORS["positive"] if delta and delta != "—" and not delta.startswith("-") else COLORS["negative"]
+    return build_kpi_template().format(title=title, value=value, delta=delta, icon=icon, trend_color=trend_color)
 
 def create_advanced_chart(df, chart_type="bar", title="", height=400):
     """Create advanced charts with consistent styling."""
@@ -240,6 +404,304 @@ def create_advanced_chart(df, chart_type="bar", title="", height=400):
     
     return fig
 
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def build_yoy_comparison_fig(top_df: pd.DataFrame) -> go.Figure:
+    """Build the top-expense CY vs LY bar chart (cached on the top-N frame)."""
+    cy_text = fmt_money_vec(top_df["CY_Amount"].to_numpy())
+    ly_text = fmt_money_vec(top_df["LY_Amount"].to_numpy())
+    
+    fig_comparison = go.Figure()
+    
+    # Current year bars
+    fig_comparison.add_trace(go.Bar(
+        name="Current Year",
+        x=top_df["Label"],
+        y=top_df["CY_Amount"],
+        marker_color=COLORS["expense"],
+        text=cy_text,
+        textposition='outside'
+    ))
+    
+    # Last year bars
+    fig_comparison.add_trace(go.Bar(
+        name="Last Year",
+        x=top_df["Label"],
+        y=top_df["LY_Amount"],
+        marker_color=COLORS["pd"],
+        text=ly_text,
+        textposition='outside'
+    ))
+    
+    fig_comparison.update_layout(
+        title="Top Expense Lines - Current vs Last Year",
+        barmode='group',
+        plot_bgcolor=COLORS['background'],
+        paper_bgcolor=COLORS['background'],
+        font_color=COLORS['primary_text'],
+        height=500,
+        xaxis_tickangle=-45,
+        xaxis=dict(gridcolor=COLORS['border'], showgrid=True),
+        yaxis=dict(gridcolor=COLORS['border'], showgrid=True)
+    )
+    
+    return fig_comparison
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def build_trend_fig(categories: tuple, cy_values: tuple, ly_values: tuple) -> go.Figure:
+    """Build the category YoY comparison bar chart."""
+    fig_trend = go.Figure()
+    fig_trend.add_trace(go.Bar(
+        name="Current Year",
+        x=list(categories),
+        y=list(cy_values),
+        marker_color=[COLORS["expense"], COLORS["pd"], COLORS["ch"], COLORS["accent"]]
+    ))
+    fig_trend.add_trace(go.Bar(
+        name="Last Year",
+        x=list(categories),
+        y=list(ly_values),
+        marker_color=[adjust_hex_color(COLORS["expense"], 0.7), 
+                     adjust_hex_color(COLORS["pd"], 0.7), 
+                     adjust_hex_color(COLORS["ch"], 0.7), 
+                     adjust_hex_color(COLORS["accent"], 0.7)]
+    ))
+    
+    fig_trend.update_layout(
+        title="Year-over-Year Comparison",
+        barmode='group',
+        plot_bgcolor=COLORS['background'],
+        paper_bgcolor=COLORS['background'],
+        font_color=COLORS['primary_text'],
+        height=400,
+        xaxis=dict(gridcolor=COLORS['border'], showgrid=True),
+        yaxis=dict(gridcolor=COLORS['border'], showgrid=True)
+    )
+    
+    return fig_trend
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def build_growth_fig(growth_rates: tuple) -> go.Figure:
+    """Build the per-category growth rate bar chart."""
+    fig_growth = go.Figure(go.Bar(
+        x=["Expenses", "PD", "CH"],
+        y=list(growth_rates),
+        marker_color=[COLORS["positive"] if x >= 0 else COLORS["negative"] for x in growth_rates],
+        text=pd.Series(growth_rates).map("{:+.1f}%".format),
+        textposition='outside'
+    ))
+    
+    fig_growth.update_layout(
+        title="Growth Rates (YoY %)",
+        plot_bgcolor=COLORS['background'],
+        paper_bgcolor=COLORS['background'],
+        font_color=COLORS['primary_text'],
+        height=400,
+        yaxis_title="Growth Rate (%)",
+        xaxis=dict(gridcolor=COLORS['border'], showgrid=True),
+        yaxis=dict(gridcolor=COLORS['border'], showgrid=True)
+    )
+    
+    return fig_growth
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def build_treemap_fig(hier: pd.DataFrame) -> go.Figure:
+    """Build the Type -> Account Description treemap from a hierarchy rollup."""
+    fig_treemap = px.treemap(
+        hier,
+        path=['Type', 'Account Description'],
+        values='CY_Amount',
+        title="Expense Distribution by Category",
+        color='CY_Amount',
+        color_continuous_scale=[COLORS['expense'], COLORS['pd'], COLORS['ch']]
+    )
+    
+    fig_treemap.update_layout(
+        plot_bgcolor=COLORS['background'],
+        paper_bgcolor=COLORS['background'],
+        font_color=COLORS['primary_text'],
+        height=600
+    )
+    
+    return fig_treemap
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def build_sunburst_fig(hier: pd.DataFrame) -> go.Figure:
+    """Build the Type -> Account Description sunburst from a hierarchy rollup."""
+    fig_sunburst = px.sunburst(
+        hier,
+        path=['Type', 'Account Description'],
+        values='CY_Amount',
+        title="Hierarchical Expense Structure",
+        color='CY_Amount',
+        color_continuous_scale=[COLORS['expense'], COLORS['pd'], COLORS['ch']]
+    )
+    
+    fig_sunburst.update_layout(
+        plot_bgcolor=COLORS['background'],
+        paper_bgcolor=COLORS['background'],
+        font_color=COLORS['primary_text'],
+        height=600
+    )
+    
+    return fig_sunburst
+
+@st.cache_resource
+def build_css() -> str:
+    """Build the global stylesheet once per server process."""
+    return f"""
+        <style>
+            /* Main app styling */
+            .stApp {{
+                background: linear-gradient(135deg, {COLORS['background']}, {adjust_hex_color(COLORS['background'], 1.02)});
+                color: {COLORS['primary_text']};
+            }}
+            
+            /* Sidebar styling */
+            .css-1d391kg {{
+                background-color: {COLORS['surface']};
+            }}
+            
+            /* Headers */
+            h1, h2, h3, h4, h5, h6 {{
+                color: {COLORS['primary_text']};
+                font-family: 'Segoe UI', Arial, sans-serif;
+                font-weight: 600;
+            }}
+            
+            /* Metric cards */
+            .stMetric {{
+                background: linear-gradient(135deg, {COLORS['card_bg']}, {adjust_hex_color(COLORS['card_bg'], 1.05)});
+                border-radius: 12px;
+                padding: 15px;
+                border: 1px solid {COLORS['border']};
+                box-shadow: 0 4px 6px rgba(0,0,0,0.3);
+            }}
+            
+            .stMetric .value {{
+                color: {COLORS['primary_text']};
+                font-size: 1.8em;
+                font-weight: bold;
+            }}
+            
+            .stMetric .label {{
+                color: {COLORS['secondary_text']};
+                font-size: 0.9em;
+            }}
+            
+            .stMetric .delta {{
+                color: {COLORS['positive']};
+                font-weight: 500;
+            }}
+            
+            /* Buttons */
+            .stButton > button {{
+                background: linear-gradient(135deg, {COLORS['accent']}, {adjust_hex_color(COLORS['accent'], 0.9)});
+                color: {COLORS['primary_text']};
+                border-radius: 8px;
+                padding: 10px 20px;
+                border: none;
+                font-weight: 500;
+                transition: all 0.3s ease;
+                box-shadow: 0 2px 4px rgba(0,0,0,0.2);
+            }}
+            
+            .stButton > button:hover {{
+                background: linear-gradient(135deg, {adjust_hex_color(COLORS['accent'], 1.1)}, {COLORS['accent']});
+                transform: translateY(-2px);
+                box-shadow: 0 4px 8px rgba(0,0,0,0.3);
+            }}
+            
+            /* Dataframes */
+            [data-testid="stDataFrameResizable"], .stDataFrame, .stTable {{
+                background-color: {COLORS['surface']} !important;
+                border-radius: 12px;
+                border: 1px solid {COLORS['border']} !important;
+                overflow: hidden;
+            }}
+            
+            [data-testid="stDataFrameResizable"] table, .stDataFrame table, .stTable table {{
+                background-color: {COLORS['surface']} !important;
+                color: {COLORS['primary_text']} !important;
+            }}
+            
+            [data-testid="stDataFrameResizable"] th, [data-testid="stDataFrameResizable"] td,
+            .stDataFrame th, .stDataFrame td, .stTable th, .stTable td {{
+                background-color: {COLORS['surface']} !important;
+                color: {COLORS['primary_text']} !important;
+                border: 1px solid {COLORS['border']} !important;
+                padding: 12px 8px;
+            }}
+            
+            [data-testid="stDataFrameResizable"] thead tr th,
+            .stDataFrame thead tr th, .stTable thead tr th {{
+                background-color: {adjust_hex_color(COLORS['surface'], 1.1)} !important;
+                color: {COLORS['primary_text']} !important;
+                font-weight: bold;
+                text-transform: uppercase;
+                font-size: 0.85em;
+                letter-spacing: 0.5px;
+            }}
+            
+            /* Input fields */
+            .stTextInput > div > input, .stNumberInput > div > input,
+            .stSelectbox > div > select, .stMultiselect > div > div {{
+                background-color: {COLORS['surface']} !important;
+                color: {COLORS['primary_text']} !important;
+                border: 1px solid {COLORS['border']} !important;
+                border-radius: 8px;
+                padding: 8px 12px;
+            }}
+            
+            /* Expanders */
+            .streamlit-expanderHeader {{
+                background-color: {COLORS['surface']} !important;
+                color: {COLORS['primary_text']} !important;
+                border-radius: 8px;
+                border: 1px solid {COLORS['border']} !important;
+            }}
+            
+            /* Tabs */
+            .stTabs [data-baseweb="tab-list"] {{
+                gap: 8px;
+            }}
+            
+            .stTabs [data-baseweb="tab"] {{
+                background-color: {COLORS['surface']};
+                border-radius: 8px 8px 0px 0px;
+                color: {COLORS['secondary_text']};
+                border: 1px solid {COLORS['border']};
+            }}
+            
+            .stTabs [aria-selected="true"] {{
+                background-color: {COLORS['accent']};
+                color: {COLORS['primary_text']};
+            }}
+            
+            /* Custom scrollbar */
+            ::-webkit-scrollbar {{
+                width: 8px;
+            }}
+            
+            ::-webkit-scrollbar-track {{
+                background: {COLORS['surface']};
+            }}
+            
+            ::-webkit-scrollbar-thumb {{
+                background: {COLORS['border']};
+                border-radius: 4px;
+            }}
+            
+            ::-webkit-scrollbar-thumb:hover {{
+                background: {COLORS['accent']};
+            }}
+        </style>
+    """
+
+# st.fragment (Streamlit >= 1.37) lets a tab rerun on its own when only its
+# widgets change; older releases simply run the tab body inline
+_st_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+_fragment = _st_fragment or (lambda func: func)
+
 # ---------------------------
 # Streamlit Page Config
 # ---------------------------
@@ -253,157 +715,9 @@ st.set_page_config(
 # ---------------------------
 # Custom CSS for Premium Styling
 # ---------------------------
-st.markdown(
-    f"""
-    <style>
-        /* Main app styling */
-        .stApp {{
-            background: linear-gradient(135deg, {COLORS['background']}, {adjust_hex_color(COLORS['background'], 1.02)});
-            color: {COLORS['primary_text']};
-        }}
-        
-        /* Sidebar styling */
-        .css-1d391kg {{
-            background-color: {COLORS['surface']};
-        }}
-        
-        /* Headers */
-        h1, h2, h3, h4, h5, h6 {{
-            color: {COLORS['primary_text']};
-            font-family: 'Segoe UI', Arial, sans-serif;
-            font-weight: 600;
-        }}
-        
-        /* Metric cards */
-        .stMetric {{
-            background: linear-gradient(135deg, {COLORS['card_bg']}, {adjust_hex_color(COLORS['card_bg'], 1.05)});
-            border-radius: 12px;
-            padding: 15px;
-            border: 1px solid {COLORS['border']};
-            box-shadow: 0 4px 6px rgba(0,0,0,0.3);
-        }}
-        
-        .stMetric .value {{
-            color: {COLORS['primary_text']};
-            font-size: 1.8em;
-            font-weight: bold;
-        }}
-        
-        .stMetric .label {{
-            color: {COLORS['secondary_text']};
-            font-size: 0.9em;
-        }}
-        
-        .stMetric .delta {{
-            color: {COLORS['positive']};
-            font-weight: 500;
-        }}
-        
-        /* Buttons */
-        .stButton > button {{
-            background: linear-gradient(135deg, {COLORS['accent']}, {adjust_hex_color(COLORS['accent'], 0.9)});
-            color: {COLORS['primary_text']};
-            border-radius: 8px;
-            padding: 10px 20px;
-            border: none;
-            font-weight: 500;
-            transition: all 0.3s ease;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.2);
-        }}
-        
-        .stButton > button:hover {{
-            background: linear-gradient(135deg, {adjust_hex_color(COLORS['accent'], 1.1)}, {COLORS['accent']});
-            transform: translateY(-2px);
-            box-shadow: 0 4px 8px rgba(0,0,0,0.3);
-        }}
-        
-        /* Dataframes */
-        [data-testid="stDataFrameResizable"], .stDataFrame, .stTable {{
-            background-color: {COLORS['surface']} !important;
-            border-radius: 12px;
-            border: 1px solid {COLORS['border']} !important;
-            overflow: hidden;
-        }}
-        
-        [data-testid="stDataFrameResizable"] table, .stDataFrame table, .stTable table {{
-            background-color: {COLORS['surface']} !important;
-            color: {COLORS['primary_text']} !important;
-        }}
-        
-        [data-testid="stDataFrameResizable"] th, [data-testid="stDataFrameResizable"] td,
-        .stDataFrame th, .stDataFrame td, .stTable th, .stTable td {{
-            background-color: {COLORS['surface']} !important;
-            color: {COLORS['primary_text']} !important;
-            border: 1px solid {COLORS['border']} !important;
-            padding: 12px 8px;
-        }}
-        
-        [data-testid="stDataFrameResizable"] thead tr th,
-        .stDataFrame thead tr th, .stTable thead tr th {{
-            background-color: {adjust_hex_color(COLORS['surface'], 1.1)} !important;
-            color: {COLORS['primary_text']} !important;
-            font-weight: bold;
-            text-transform: uppercase;
-            font-size: 0.85em;
-            letter-spacing: 0.5px;
-        }}
-        
-        /* Input fields */
-        .stTextInput > div > input, .stNumberInput > div > input,
-        .stSelectbox > div > select, .stMultiselect > div > div {{
-            background-color: {COLORS['surface']} !important;
-            color: {COLORS['primary_text']} !important;
-            border: 1px solid {COLORS['border']} !important;
-            border-radius: 8px;
-            padding: 8px 12px;
-        }}
-        
-        /* Expanders */
-        .streamlit-expanderHeader {{
-            background-color: {COLORS['surface']} !important;
-            color: {COLORS['primary_text']} !important;
-            border-radius: 8px;
-            border: 1px solid {COLORS['border']} !important;
-        }}
-        
-        /* Tabs */
-        .stTabs [data-baseweb="tab-list"] {{
-            gap: 8px;
-        }}
-        
-        .stTabs [data-baseweb="tab"] {{
-            background-color: {COLORS['surface']};
-            border-radius: 8px 8px 0px 0px;
-            color: {COLORS['secondary_text']};
-            border: 1px solid {COLORS['border']};
-        }}
-        
-        .stTabs [aria-selected="true"] {{
-            background-color: {COLORS['accent']};
-            color: {COLORS['primary_text']};
-        }}
-        
-        /* Custom scrollbar */
-        ::-webkit-scrollbar {{
-            width: 8px;
-        }}
-        
-        ::-webkit-scrollbar-track {{
-            background: {COLORS['surface']};
-        }}
-        
-        ::-webkit-scrollbar-thumb {{
-            background: {COLORS['border']};
-            border-radius: 4px;
-        }}
-        
-        ::-webkit-scrollbar-thumb:hover {{
-            background: {COLORS['accent']};
-        }}
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+# The string is cached, but it must still be emitted on every rerun: Streamlit
+# drops elements that a rerun does not re-create.
+st.markdown(build_css(), unsafe_allow_html=True)
 
 # ---------------------------
 # Sidebar Configuration
@@ -512,31 +826,17 @@ except Exception as e:
     st.info("Please check your file path and worksheet name in the sidebar.")
     st.stop()
 
-# Apply filters
-df_filtered = df[df["Type"].isin([t.upper() for t in type_filter])].copy()
-
-# Split by type
-df_exp = df_filtered[df_filtered["Type"] == "EXPENSE"].copy()
-df_pd = df_filtered[df_filtered["Type"] == "PD"].copy()
-df_ch = df_filtered[df_filtered["Type"] == "CH"].copy()
+# Apply filters and aggregate every type in one pass (cached on data + filter,
+# so unrelated widget changes reuse the result); only expense rows are needed downstream
+selected_types = tuple(sorted({t.upper() for t in type_filter}))
+df_filtered, type_agg = compute_totals(df, selected_types)
+df_exp = df_filtered[df_filtered["Type"].eq("EXPENSE")]
 
 # Calculate totals
 totals = {
-    "expense": {
-        "cy": float(df_exp["CY_Amount"].sum()),
-        "ly": float(df_exp["LY_Amount"].sum()),
-        "icon": get_category_icon("EXPENSE")
-    },
-    "pd": {
-        "cy": float(df_pd["CY_Amount"].sum()),
-        "ly": float(df_pd["LY_Amount"].sum()),
-        "icon": get_category_icon("PD")
-    },
-    "ch": {
-        "cy": float(df_ch["CY_Amount"].sum()),
-        "ly": float(df_ch["LY_Amount"].sum()),
-        "icon": get_category_icon("CH")
-    }
+    "expense": type_totals(type_agg, "EXPENSE"),
+    "pd": type_totals(type_agg, "PD"),
+    "ch": type_totals(type_agg, "CH")
 }
 
 totals["grand"] = {
@@ -615,9 +915,9 @@ with col4:
 # ---------------------------
 st.markdown("---")
 
-tab1, tab2, tab3, tab4 = st.tabs(["📊 Expense Analysis", "📈 Trends & Comparisons", "🌳 Hierarchical View", "📋 Detailed Data"])
-
-with tab1:
+@_fragment
+def render_expense_tab(df_exp, top_n, show_ly):
+    """Tab 1: top expense lines, summary table and export."""
     st.subheader("📊 Top Expense Analysis")
     
     if df_exp.empty:
@@ -628,89 +928,29 @@ with tab1:
         
         # Create comparison chart
         if show_ly:
-            fig_comparison = go.Figure()
-            
-            # Current year bars
-            fig_comparison.add_trace(go.Bar(
-                name="Current Year",
-                x=top_df["Label"],
-                y=top_df["CY_Amount"],
-                marker_color=COLORS["expense"],
-                text=[fmt_money(x) for x in top_df["CY_Amount"]],
-                textposition='outside'
-            ))
-            
-            # Last year bars
-            fig_comparison.add_trace(go.Bar(
-                name="Last Year",
-                x=top_df["Label"],
-                y=top_df["LY_Amount"],
-                marker_color=COLORS["pd"],
-                text=[fmt_money(x) for x in top_df["LY_Amount"]],
-                textposition='outside'
-            ))
-            
-            fig_comparison.update_layout(
-                title="Top Expense Lines - Current vs Last Year",
-                barmode='group',
-                plot_bgcolor=COLORS['background'],
-                paper_bgcolor=COLORS['background'],
-                font_color=COLORS['primary_text'],
-                height=500,
-                xaxis_tickangle=-45,
-                xaxis=dict(gridcolor=COLORS['border'], showgrid=True),
-                yaxis=dict(gridcolor=COLORS['border'], showgrid=True)
-            )
-            
-            st.plotly_chart(fig_comparison, use_container_width=True)
+            st.plotly_chart(build_yoy_comparison_fig(top_df), use_container_width=True)
         
         # Summary table
         st.subheader("📋 Expense Summary Table")
         
         summary_table = top_df.copy()
-        summary_table["YoY %"] = summary_table.apply(
-            lambda r: make_yoy_str(r["CY_Amount"], r["LY_Amount"]), axis=1
-        )
-        summary_table["Trend"] = summary_table.apply(
-            lambda r: get_trend_icon(r["CY_Amount"], r["LY_Amount"]), axis=1
-        )
+        summary_table["YoY %"] = make_yoy_str_vec(summary_table["CY_Amount"], summary_table["LY_Amount"])
+        summary_table["Trend"] = get_trend_icon_vec(summary_table["CY_Amount"], summary_table["LY_Amount"])
         
         # Format for display
         display_table = summary_table[["Rank", "Label", "CY_Amount", "LY_Amount", "YoY %", "Trend"]].copy()
         display_table.columns = ["Rank", "Description", "Current Year", "Last Year", "YoY %", "Trend"]
+        display_table["Current Year"] = fmt_money_vec(display_table["Current Year"].to_numpy())
+        display_table["Last Year"] = fmt_money_vec(display_table["Last Year"].to_numpy())
         
         st.dataframe(
-            display_table.style.format({
-                "Current Year": lambda x: fmt_money(x),
-                "Last Year": lambda x: fmt_money(x)
-            }),
+            display_table,
             use_container_width=True,
             height=400
         )
         
-        # JavaScript to ensure table styling
-        st.components.v1.html(
-            f"""
-            <script>
-                document.querySelectorAll('[data-testid="stDataFrameResizable"] table').forEach(table => {{
-                    table.style.backgroundColor = '{COLORS["surface"]}';
-                    table.querySelectorAll('th, td').forEach(cell => {{
-                        cell.style.backgroundColor = '{COLORS["surface"]}';
-                        cell.style.color = '{COLORS["primary_text"]}';
-                        cell.style.border = '1px solid {COLORS["border"]}';
-                    }});
-                    table.querySelectorAll('thead tr th').forEach(header => {{
-                        header.style.backgroundColor = '{adjust_hex_color(COLORS["surface"], 1.1)}';
-                        header.style.color = '{COLORS["primary_text"]}';
-                    }});
-                }});
-            </script>
-            """,
-            height=0
-        )
-        
         # Export button
-        csv_data = summary_table.to_csv(index=False)
+        csv_data = to_csv_bytes(summary_table)
         st.download_button(
             label="📥 Download Expense Summary",
             data=csv_data,
@@ -718,7 +958,9 @@ with tab1:
             mime="text/csv"
         )
 
-with tab2:
+@_fragment
+def render_trends_tab(totals):
+    """Tab 2: category YoY comparison and growth rates."""
     st.subheader("📈 Trend Analysis & Comparisons")
     
     # Create trend analysis
@@ -730,34 +972,7 @@ with tab2:
         cy_values = [totals["expense"]["cy"], totals["pd"]["cy"], totals["ch"]["cy"], totals["grand"]["cy"]]
         ly_values = [totals["expense"]["ly"], totals["pd"]["ly"], totals["ch"]["ly"], totals["grand"]["ly"]]
         
-        fig_trend = go.Figure()
-        fig_trend.add_trace(go.Bar(
-            name="Current Year",
-            x=categories,
-            y=cy_values,
-            marker_color=[COLORS["expense"], COLORS["pd"], COLORS["ch"], COLORS["accent"]]
-        ))
-        fig_trend.add_trace(go.Bar(
-            name="Last Year",
-            x=categories,
-            y=ly_values,
-            marker_color=[adjust_hex_color(COLORS["expense"], 0.7), 
-                         adjust_hex_color(COLORS["pd"], 0.7), 
-                         adjust_hex_color(COLORS["ch"], 0.7), 
-                         adjust_hex_color(COLORS["accent"], 0.7)]
-        ))
-        
-        fig_trend.update_layout(
-            title="Year-over-Year Comparison",
-            barmode='group',
-            plot_bgcolor=COLORS['background'],
-            paper_bgcolor=COLORS['background'],
-            font_color=COLORS['primary_text'],
-            height=400,
-            xaxis=dict(gridcolor=COLORS['border'], showgrid=True),
-            yaxis=dict(gridcolor=COLORS['border'], showgrid=True)
-        )
-        
+        fig_trend = build_trend_fig(tuple(categories), tuple(cy_values), tuple(ly_values))
         st.plotly_chart(fig_trend, use_container_width=True)
     
     with col2:
@@ -767,103 +982,81 @@ with tab2:
             pct = safe_pct(cy_values[i], ly_values[i])
             growth_rates.append(pct * 100 if pct is not None else 0)
         
-        fig_growth = go.Figure(go.Bar(
-            x=["Expenses", "PD", "CH"],
-            y=growth_rates,
-            marker_color=[COLORS["positive"] if x >= 0 else COLORS["negative"] for x in growth_rates],
-            text=[f"{x:+.1f}%" for x in growth_rates],
-            textposition='outside'
-        ))
-        
-        fig_growth.update_layout(
-            title="Growth Rates (YoY %)",
-            plot_bgcolor=COLORS['background'],
-            paper_bgcolor=COLORS['background'],
-            font_color=COLORS['primary_text'],
-            height=400,
-            yaxis_title="Growth Rate (%)",
-            xaxis=dict(gridcolor=COLORS['border'], showgrid=True),
-            yaxis=dict(gridcolor=COLORS['border'], showgrid=True)
-        )
-        
+        fig_growth = build_growth_fig(tuple(growth_rates))
         st.plotly_chart(fig_growth, use_container_width=True)
 
-with tab3:
+@_fragment
+def render_hierarchy_tab(df_filtered):
+    """Tab 3: treemap and sunburst of the Type -> Account hierarchy."""
     st.subheader("🌳 Hierarchical Data Visualization")
     
+    # Without fragments every rerun would rebuild these charts, so make them opt-in
+    if _st_fragment is None and not st.checkbox("Render hierarchical charts", value=False):
+        return
+    
     # Treemap visualization
     if not df_filtered.empty:
-        fig_treemap = px.treemap(
-            df_filtered,
-            path=['Type', 'Account Description'],
-            values='CY_Amount',
-            title="Expense Distribution by Category",
-            color='CY_Amount',
-            color_continuous_scale=[COLORS['expense'], COLORS['pd'], COLORS['ch']]
-        )
+        # Roll up the Type -> Account Description hierarchy once for both charts
+        hier = df_filtered.groupby(
+            ['Type', 'Account Description'], as_index=False, sort=False, observed=True
+        )['CY_Amount'].sum()
         
-        fig_treemap.update_layout(
-            plot_bgcolor=COLORS['background'],
-            paper_bgcolor=COLORS['background'],
-            font_color=COLORS['primary_text'],
-            height=600
-        )
-        
-        st.plotly_chart(fig_treemap, use_container_width=True)
+        st.plotly_chart(build_treemap_fig(hier), use_container_width=True)
         
         # Sunburst chart
         st.subheader("🌞 Sunburst Chart")
-        fig_sunburst = px.sunburst(
-            df_filtered,
-            path=['Type', 'Account Description'],
-            values='CY_Amount',
-            title="Hierarchical Expense Structure",
-            color='CY_Amount',
-            color_continuous_scale=[COLORS['expense'], COLORS['pd'], COLORS['ch']]
-        )
-        
-        fig_sunburst.update_layout(
-            plot_bgcolor=COLORS['background'],
-            paper_bgcolor=COLORS['background'],
-            font_color=COLORS['primary_text'],
-            height=600
-        )
-        
-        st.plotly_chart(fig_sunburst, use_container_width=True)
+        if len(hier) > SUNBURST_MAX_NODES:
+            st.info(f"Sunburst hidden for readability ({len(hier):,} accounts). Use the treemap above.")
+        else:
+            st.plotly_chart(build_sunburst_fig(hier), use_container_width=True)
 
-with tab4:
+@_fragment
+def render_detail_tab(df_filtered, max_rows):
+    """Tab 4: searchable account-level table."""
     st.subheader("📋 Detailed Data View")
     
     # Search functionality
     search_term = st.text_input("🔍 Search accounts:", placeholder="Enter account description...")
     
     if search_term:
-        filtered_data = df_filtered[
-            df_filtered["Account Description"].str.contains(search_term, case=False, na=False)
-        ]
+        # Plain case-insensitive substring match; only the first max_rows hits are materialized
+        matches = np.flatnonzero(np.char.find(lower_descriptions(df_filtered), search_term.lower()) >= 0)
+        match_count = len(matches)
+        display_data = df_filtered.iloc[matches[:max_rows]].copy()
     else:
-        filtered_data = df_filtered
+        match_count = len(df_filtered)
+        display_data = df_filtered.head(max_rows).copy()
     
     # Display filtered data
-    if not filtered_data.empty:
-        display_data = filtered_data.head(max_rows).copy()
-        display_data["YoY %"] = display_data.apply(
-            lambda r: make_yoy_str(r["CY_Amount"], r["LY_Amount"]), axis=1
-        )
+    if match_count:
+        display_data["YoY %"] = make_yoy_str_vec(display_data["CY_Amount"], display_data["LY_Amount"])
+        display_data["CY_Amount"] = fmt_money_vec(display_data["CY_Amount"].to_numpy())
+        display_data["LY_Amount"] = fmt_money_vec(display_data["LY_Amount"].to_numpy())
         
         st.dataframe(
-            display_data[["Account ID", "Account Description", "Type", "CY_Amount", "LY_Amount", "YoY %"]].style.format({
-                "CY_Amount": lambda x: fmt_money(x),
-                "LY_Amount": lambda x: fmt_money(x)
-            }),
+            display_data[["Account ID", "Account Description", "Type", "CY_Amount", "LY_Amount", "YoY %"]],
             use_container_width=True,
             height=500
         )
         
-        st.info(f"Showing {len(display_data)} of {len(filtered_data)} records. Use search to filter results.")
+        st.info(f"Showing {len(display_data)} of {match_count} records. Use search to filter results.")
     else:
         st.warning("No data found matching your search criteria.")
 
+tab1, tab2, tab3, tab4 = st.tabs(["📊 Expense Analysis", "📈 Trends & Comparisons", "🌳 Hierarchical View", "📋 Detailed Data"])
+
+with tab1:
+    render_expense_tab(df_exp, top_n, show_ly)
+
+with tab2:
+    render_trends_tab(totals)
+
+with tab3:
+    render_hierarchy_tab(df_filtered)
+
+with tab4:
+    render_detail_tab(df_filtered, max_rows)
+
 # ---------------------------
 # Footer
 # ---------------------------